@@ -2,19 +2,34 @@ from __future__ import annotations
 
 import os
 import logging
-from typing import Any, Dict, List, Optional
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 
 import asyncpg
+import orjson
 
 logger = logging.getLogger("anima")
 
 
+def _jsonb_encode(value: Any) -> str:
+    return orjson.dumps(value).decode()
+
+
+async def _init_connection(conn: asyncpg.Connection) -> None:
+    # jsonb params/results are plain Python objects, (de)serialized by orjson
+    await conn.set_type_codec("jsonb", encoder=_jsonb_encode, decoder=orjson.loads, schema="pg_catalog")
+
+
 async def create_pool(dsn: str) -> asyncpg.Pool:
     return await asyncpg.create_pool(
         dsn=dsn,
         min_size=int(os.getenv("DB_POOL_MIN", "1")),
-        max_size=int(os.getenv("DB_POOL_MAX", "5")),
+        max_size=int(os.getenv("DB_POOL_MAX", "25")),
         command_timeout=float(os.getenv("DB_COMMAND_TIMEOUT", "15")),
+        # asyncpg prepares each distinct SQL text once per connection and reuses it
+        statement_cache_size=int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100")),
+        init=_init_connection,
     )
 
 
@@ -28,28 +43,49 @@ def _pool() -> asyncpg.Pool:
     return pool
 
 
+_bound: ContextVar[Optional[asyncpg.Connection]] = ContextVar("anima_db_conn", default=None)
+
+
+@asynccontextmanager
+async def connection() -> AsyncIterator[asyncpg.Connection]:
+    # Reuses the connection bound by an enclosing connection() block, so a
+    # whole webhook can run on one pool checkout instead of one per query.
+    conn = _bound.get()
+    if conn is not None:
+        yield conn
+        return
+    async with _pool().acquire() as conn:
+        token = _bound.set(conn)
+        try:
+            yield conn
+        finally:
+            _bound.reset(token)
+
+
 async def fetch(sql: str, *params: Any) -> List[Dict[str, Any]]:
-    pool = _pool()
-    async with pool.acquire() as conn:
+    async with connection() as conn:
         rows = await conn.fetch(sql, *params)
         return [dict(r) for r in rows]
 
 
 async def fetchval(sql: str, *params: Any) -> Any:
-    pool = _pool()
-    async with pool.acquire() as conn:
+    async with connection() as conn:
         return await conn.fetchval(sql, *params)
 
 
 async def execute(sql: str, *params: Any) -> str:
-    pool = _pool()
-    async with pool.acquire() as conn:
+    async with connection() as conn:
         return await conn.execute(sql, *params)
 
 
+async def executemany(sql: str, args: List[Tuple[Any, ...]]) -> None:
+    async with connection() as conn:
+        await conn.executemany(sql, args)
+
+
 async def mark_update_processed(update_id: int) -> bool:
-    status = await execute(
-        "INSERT INTO processed_updates(update_id) VALUES($1) ON CONFLICT DO NOTHING",
+    inserted = await fetchval(
+        "INSERT INTO processed_updates(update_id) VALUES($1) ON CONFLICT DO NOTHING RETURNING 1",
         update_id,
     )
-    return status.endswith(" 1")
+    return inserted is not None
@@ -6,12 +6,17 @@ from typing import Any, Dict
 
 from dotenv import load_dotenv
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 
-from api.db import create_pool
-from api.routes.telegram import router as telegram_router
-
+# Before the api.* imports: their modules read tuning knobs (cache sizes,
+# queue limits, tokens) from the environment at import time.
 load_dotenv()
 
+from api.db import create_pool  # noqa: E402
+from api.routes.telegram import router as telegram_router  # noqa: E402
+from api.services.dialogue import start_event_writer, stop_event_writer  # noqa: E402
+from api.services.telegram import close_client, create_client, start_senders, stop_senders  # noqa: E402
+
 APP_TITLE = os.getenv("APP_TITLE", "ANIMA 2.0")
 DB_URL = os.getenv("DATABASE_URL", "")
 
@@ -21,7 +26,7 @@ logging.basicConfig(
     format="%(asctime)s %(levelname)s %(name)s %(message)s",
 )
 
-app = FastAPI(title=APP_TITLE)
+app = FastAPI(title=APP_TITLE, default_response_class=ORJSONResponse)
 app.include_router(telegram_router)
 
 
@@ -32,6 +37,8 @@ async def root() -> Dict[str, Any]:
 
 @app.on_event("startup")
 async def startup() -> None:
+    create_client()
+    start_senders()
     if not DB_URL:
         logger.warning("DATABASE_URL is not set. DB features will fail.")
         return
@@ -41,11 +48,15 @@ async def startup() -> None:
     except Exception:
         logger.exception("Failed to create DB pool.")
         raise
+    start_event_writer()
 
 
 @app.on_event("shutdown")
 async def shutdown() -> None:
+    await stop_event_writer()
     pool = getattr(app.state, "db_pool", None)
     if pool:
         await pool.close()
         logger.info("DB pool closed.")
+    await stop_senders()
+    await close_client()
@@ -3,18 +3,18 @@ from __future__ import annotations
 import logging
 import os
 import re
-from typing import Any, Dict, Optional
+from typing import Any, Awaitable, Callable, Dict, Optional
 
 from fastapi import APIRouter, HTTPException, Request
 from pydantic import BaseModel
 
+from api.db import connection
 from api.services.telegram import tg_send
 from api.services.dialogue import (
-    STOP,
+    HUMOR_RX,
     app_state,
     build_reply,
     compose_menu,
-    crisis_detect,
     detect_emotion,
     ensure_user,
     get_profile_style,
@@ -25,6 +25,7 @@ from api.services.dialogue import (
     log_event,
     not_duplicate,
     quality_score,
+    safety_check,
     set_state,
 )
 
@@ -34,6 +35,8 @@ router = APIRouter()
 
 WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
 
+DIGIT_RX = re.compile(r"\d")
+
 
 class TelegramUpdate(BaseModel):
     update_id: Optional[int] = None
@@ -61,10 +64,50 @@ async def webhook(update: TelegramUpdate, request: Request) -> Dict[str, Any]:
     if not update.message:
         return {"ok": True}
 
-    msg = update.message
+    async with connection():
+        return await _handle_message(update.message)
+
+
+async def _cmd_humor(uid: int, chat_id: int, tl: str) -> Dict[str, Any]:
+    on = any(w in tl for w in ["on", "вкл", "да", "true"])
+    await set_state(uid, {"humor_on": on})
+    await tg_send(chat_id, "Юмор включён 😊" if on else "Юмор выключен 👍")
+    return {"ok": True}
+
+
+async def _cmd_start(uid: int, chat_id: int, tl: str) -> Dict[str, Any]:
+    await set_state(uid, {"intro_done": False, "name": None, "kno_idx": None, "kno_done": False, "menu_map": {}})
+    greet = (
+        "Привет 🌿 Я Анима — твой личный психологический ассистент. "
+        "Я помогаю навести ясность, снизить стресс и наметить шаги вперёд. "
+        "Наши разговоры конфиденциальны, никакого спама — только поддержка 💛\n\n"
+        "Как мне к тебе обращаться?"
+    )
+    await tg_send(chat_id, greet)
+    await log_event(uid, "assistant", greet, "engage")
+    return {"ok": True}
+
+
+_COMMANDS: Dict[str, Callable[[int, int, str], Awaitable[Dict[str, Any]]]] = {
+    "/humor": _cmd_humor,
+    "/start": _cmd_start,
+    "start": _cmd_start,
+}
+
+
+def _command_key(tl: str) -> str:
+    # Slash commands match on their first token ("/humor on", "/start@bot");
+    # bare words only as the whole message.
+    if tl.startswith("/"):
+        return tl.split(maxsplit=1)[0].split("@", 1)[0]
+    return tl
+
+
+async def _handle_message(msg: Dict[str, Any]) -> Dict[str, Any]:
     chat_id = int(msg["chat"]["id"])
     uid = chat_id
     text = (msg.get("text") or "").strip()
+    tl = text.lower()
 
     u = msg.get("from", {}) or {}
     try:
@@ -74,22 +117,20 @@ async def webhook(update: TelegramUpdate, request: Request) -> Dict[str, Any]:
 
     logger.info("telegram_update chat_id=%s text_len=%s", chat_id, len(text))
 
-    # toggles
-    if text.lower().startswith("/humor"):
-        on = any(w in text.lower() for w in ["on", "вкл", "да", "true"])
-        st = await app_state(uid)
-        st["humor_on"] = on
-        await set_state(uid, st)
-        await tg_send(chat_id, "Юмор включён 😊" if on else "Юмор выключен 👍")
-        return {"ok": True}
+    # Safety runs before command dispatch so "/start не хочу жить" still gets
+    # the crisis reply; safe commands then skip the KNO/dialogue path.
+    safety = safety_check(tl)
+    if safety is None:
+        cmd = _COMMANDS.get(_command_key(tl))
+        if cmd is not None:
+            return await cmd(uid, chat_id, tl)
 
     st = await app_state(uid)
-    if re.search(r"\bпошути\b|немного юмора|чуть иронии", text.lower()):
+    if HUMOR_RX.search(tl):
         st["humor_on"] = True
-        await set_state(uid, st)
+        await set_state(uid, {"humor_on": True})
 
-    # Safety
-    if crisis_detect(text):
+    if safety == "crisis":
         reply = (
             "Я рядом и слышу твою боль. Если нужна поддержка прямо сейчас — "
             "обратись к близким или в службу помощи. "
@@ -99,7 +140,7 @@ async def webhook(update: TelegramUpdate, request: Request) -> Dict[str, Any]:
         await log_event(uid, "assistant", reply, "support", "tense", False)
         return {"ok": True}
 
-    if STOP.search(text):
+    if safety == "stop":
         reply = "Давай оставим чувствительные темы за рамками. О чём тебе важнее поговорить сейчас?"
         await tg_send(chat_id, reply)
         await log_event(uid, "assistant", reply, "engage", "neutral", False)
@@ -109,21 +150,9 @@ async def webhook(update: TelegramUpdate, request: Request) -> Dict[str, Any]:
     name = st.get("name")
     intro_done = bool(st.get("intro_done", False))
 
-    if text.lower() in ("/start", "start"):
-        await set_state(uid, {"intro_done": False, "name": None, "kno_idx": None, "kno_done": False, "menu_map": {}})
-        greet = (
-            "Привет 🌿 Я Анима — твой личный психологический ассистент. "
-            "Я помогаю навести ясность, снизить стресс и наметить шаги вперёд. "
-            "Наши разговоры конфиденциальны, никакого спама — только поддержка 💛\n\n"
-            "Как мне к тебе обращаться?"
-        )
-        await tg_send(chat_id, greet)
-        await log_event(uid, "assistant", greet, "engage")
-        return {"ok": True}
-
     if not intro_done:
         if not name:
-            if len(text) <= 40 and not re.search(r"\d", text):
+            if len(text) <= 40 and not DIGIT_RX.search(text):
                 await set_state(uid, {"name": text})
                 prompt = "Как ты сейчас? Выбери слово: спокойно, напряжённо, растерянно — или опиши по-своему."
                 await tg_send(chat_id, f"Рада знакомству, {text}! ✨")
@@ -143,7 +172,7 @@ async def webhook(update: TelegramUpdate, request: Request) -> Dict[str, Any]:
     # KNO flow
     st = await app_state(uid)
     if not st.get("kno_done"):
-        nxt = await kno_register(uid, text)
+        nxt = await kno_register(uid, text, tl)
         if nxt is None:
             summary = (
                 "Спасибо, я лучше понимаю, как с тобой говорить 💛\n"
@@ -161,7 +190,7 @@ async def webhook(update: TelegramUpdate, request: Request) -> Dict[str, Any]:
         return {"ok": True}
 
     # Free dialogue
-    emo = detect_emotion(text)
+    emo = detect_emotion(text, tl)
     humor_on = bool(st.get("humor_on"))
     style = await get_profile_style(uid)
 
@@ -175,9 +204,9 @@ async def webhook(update: TelegramUpdate, request: Request) -> Dict[str, Any]:
     if menu_choice:
         draft = menu_choice
     else:
-        draft = await build_reply(uid, text, humor_on)
+        draft = await build_reply(uid, text, humor_on, tl, emo)
 
-    if quality_score(text, draft) < 0.55:
+    if quality_score(text, draft, tl) < 0.55:
         draft = await compose_menu(uid)
 
     draft = await not_duplicate(uid, draft)
@@ -1,57 +1,80 @@
 from __future__ import annotations
 
-import json
+import asyncio
+import copy
 import logging
+import os
+import random
 import re
 import time
+from collections import OrderedDict
 from typing import Any, Callable, Dict, List, Optional, Tuple
 
-from api.db import execute, fetch, mark_update_processed
+import orjson
+
+from api.db import execute, executemany, fetch, mark_update_processed
 
 logger = logging.getLogger("anima")
 
 
-STOP = re.compile(
-    r"(политик|религ|насили|медицинск|вакцин|диагноз|лекарств|суицид)",
-    re.IGNORECASE,
-)
-CRISIS = re.compile(
-    r"(не хочу жить|самоповрежд|отчаяни|суицид|покончи|боль невыносима)",
-    re.IGNORECASE,
-)
+# Every pattern in this module is lowercase and matched against lowercased
+# text (tl), so none of them need re.IGNORECASE.
+STOP = re.compile(r"(политик|религ|насили|медицинск|вакцин|диагноз|лекарств|суицид)")
+CRISIS = re.compile(r"(не хочу жить|самоповрежд|отчаяни|суицид|покончи|боль невыносима)")
 
+EMO_TENSE_RX = re.compile(r"устал|напряж|тревож|страш|злюсь|злость|раздраж|грустн|плохо|паник")
+EMO_CALM_RX = re.compile(r"спокойн|рад|легко|хорошо|класс|радост")
+EMO_UNCERTAIN_RX = re.compile(r"не знаю|путаюсь|сомнева|непонятно|не понимаю|затрудня")
+EMPATHY_RX = re.compile(r"(слышу|вижу|понимаю|рядом|важно|чувствую)")
+WORD4_RX = re.compile(r"[а-яa-z]{4,}")
+QS_STOPWORDS = frozenset({"сейчас", "просто", "очень", "хочу"})
 
-def crisis_detect(t: str) -> bool:
-    return bool(CRISIS.search(t or ""))
+
+def safety_check(tl: str) -> Optional[str]:
+    # "crisis" outranks "stop" (e.g. "суицид").
+    if CRISIS.search(tl):
+        return "crisis"
+    if STOP.search(tl):
+        return "stop"
+    return None
 
 
-def detect_emotion(t: str) -> str:
-    tl = (t or "").lower()
-    if re.search(r"устал|напряж|тревож|страш|злюсь|злость|раздраж|грустн|плохо|паник", tl):
+def detect_emotion(t: str, tl: Optional[str] = None) -> str:
+    if tl is None:
+        tl = (t or "").lower()
+    if EMO_TENSE_RX.search(tl):
         return "tense"
-    if re.search(r"спокойн|рад|легко|хорошо|класс|радост", tl):
+    if EMO_CALM_RX.search(tl):
         return "calm"
-    if re.search(r"не знаю|путаюсь|сомнева|непонятно|не понимаю|затрудня", tl):
+    if EMO_UNCERTAIN_RX.search(tl):
         return "uncertain"
     return "neutral"
 
 
-def quality_score(user_text: str, reply: str) -> float:
+def quality_score(user_text: str, reply: str, tl: Optional[str] = None) -> float:
     s = 0.0
-    L = len(reply or "")
+    reply = reply or ""
+    rl = reply.lower()
+    L = len(reply)
     if 80 <= L <= 900:
         s += 0.25
-    if "?" in (reply or ""):
+    if "?" in reply:
         s += 0.2
-    if re.search(r"(слышу|вижу|понимаю|рядом|важно|чувствую)", (reply or "").lower()):
+    if EMPATHY_RX.search(rl):
         s += 0.25
-    tokens = [
-        w
-        for w in re.findall(r"[а-яa-z]{4,}", (user_text or "").lower())
-        if w not in {"сейчас", "просто", "очень", "хочу"}
-    ]
-    if any(t in (reply or "").lower() for t in tokens[:6]):
-        s += 0.3
+    if tl is None:
+        tl = (user_text or "").lower()
+    seen = 0
+    for m in WORD4_RX.finditer(tl):
+        w = m.group()
+        if w in QS_STOPWORDS:
+            continue
+        if w in rl:
+            s += 0.3
+            break
+        seen += 1
+        if seen == 6:
+            break
     return s
 
 
@@ -71,9 +94,52 @@ KNO_MAP: Dict[str, Tuple[str, str]] = {
     "jp_q2": ("J", "P"),
     "ei_q2": ("E", "I"),
 }
+# Per-question (first, second) choice -> slot in an E,I,S,N,T,F,J,P tally,
+# parallel to KNO.
+KNO_AXES = "EISNTFJP"
+KNO_AXIS_IDX: Tuple[Tuple[int, int], ...] = tuple(
+    (KNO_AXES.index(KNO_MAP[key][0]), KNO_AXES.index(KNO_MAP[key][1])) for key, _q in KNO
+)
+
+
+def _axis_share(counts: List[int], i: int) -> float:
+    return counts[i] / ((counts[i] + counts[i ^ 1]) or 1)
+
+
+# Keyword fallback for free-text KNO answers, by question prefix; first hit wins.
+KNO_PICK: Dict[str, Tuple[Tuple[re.Pattern, int], ...]] = {
+    "ei": ((re.compile(r"наедин|тишин|один"), 2), (re.compile(r"люд|общат|встреч"), 1)),
+    "sn": ((re.compile(r"факт|конкрет|шаг"), 1), (re.compile(r"смысл|иде|образ"), 2)),
+    "tf": ((re.compile(r"логик|рацион|аргумент"), 1), (re.compile(r"чувств|эмоци|ценност"), 2)),
+    "jp": ((re.compile(r"план|распис|контрол"), 1), (re.compile(r"свobod|свобод|импров|спонтан"), 2)),
+}
+
+
+KNO_ANSWER_MAP: Dict[str, int] = {
+    "1": 1, "первый": 1, "первое": 1, "первая": 1, "слева": 1,
+    "2": 2, "второй": 2, "второе": 2, "вторая": 2, "справа": 2,
+}
+
+
+def kno_pick(question_key: str, tt: str) -> int:
+    choice = KNO_ANSWER_MAP.get(tt)
+    if choice:
+        return choice
+    for rx, choice in KNO_PICK.get(question_key[:2], ()):
+        if rx.search(tt):
+            return choice
+    return 1
+
+
+# user_ids already inserted by this process; ensure_user is a no-op for them.
+KNOWN_UIDS_MAX = int(os.getenv("KNOWN_UIDS_MAX", "100000"))
+KNOWN_UIDS: "OrderedDict[int, None]" = OrderedDict()
 
 
 async def ensure_user(uid: int, username: Optional[str] = None, first_name: Optional[str] = None, last_name: Optional[str] = None) -> None:
+    if uid in KNOWN_UIDS:
+        KNOWN_UIDS.move_to_end(uid)
+        return
     await execute(
         """
         INSERT INTO user_profile(user_id,username,first_name,last_name)
@@ -85,29 +151,99 @@ async def ensure_user(uid: int, username: Optional[str] = None, first_name: Opti
         first_name,
         last_name,
     )
+    KNOWN_UIDS[uid] = None
+    while len(KNOWN_UIDS) > KNOWN_UIDS_MAX:
+        KNOWN_UIDS.popitem(last=False)
 
 
-async def get_facts(uid: int) -> Dict[str, Any]:
-    rows = await fetch("SELECT facts FROM user_profile WHERE user_id=$1", uid)
-    if not rows:
-        return {}
-    facts = rows[0].get("facts")
+# Per-process write-through cache of user_profile.facts (single worker deploy).
+FACTS_CACHE_TTL = float(os.getenv("FACTS_CACHE_TTL", "60"))
+FACTS_CACHE_MAX = int(os.getenv("FACTS_CACHE_MAX", "10000"))
+FACTS_CACHE: "OrderedDict[int, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+
+
+def _facts_cache_get(uid: int) -> Optional[Dict[str, Any]]:
+    hit = FACTS_CACHE.get(uid)
+    if hit is None:
+        return None
+    ts, facts = hit
+    if time.monotonic() - ts > FACTS_CACHE_TTL:
+        FACTS_CACHE.pop(uid, None)
+        return None
+    FACTS_CACHE.move_to_end(uid)
+    return copy.deepcopy(facts)
+
+
+def _facts_cache_put(uid: int, facts: Dict[str, Any], read_at: Optional[float] = None) -> None:
+    # A read that started before the cached entry was written (e.g. a set_state
+    # landing while the SELECT was in flight) must not replace it.
+    if read_at is not None:
+        hit = FACTS_CACHE.get(uid)
+        if hit is not None and hit[0] >= read_at:
+            return
+    FACTS_CACHE[uid] = (time.monotonic(), copy.deepcopy(facts))
+    FACTS_CACHE.move_to_end(uid)
+    while len(FACTS_CACHE) > FACTS_CACHE_MAX:
+        FACTS_CACHE.popitem(last=False)
+
+
+def _parse_facts(facts: Any) -> Dict[str, Any]:
     if facts is None:
         return {}
     if isinstance(facts, dict):
         return facts
     if isinstance(facts, str):
         try:
-            return json.loads(facts) or {}
+            return orjson.loads(facts) or {}
         except Exception:
             return {}
     return {}
 
 
+async def get_facts(uid: int) -> Dict[str, Any]:
+    cached = _facts_cache_get(uid)
+    if cached is not None:
+        return cached
+    read_at = time.monotonic()
+    rows = await fetch("SELECT facts FROM user_profile WHERE user_id=$1", uid)
+    if not rows:
+        return {}
+    facts = _parse_facts(rows[0].get("facts"))
+    _facts_cache_put(uid, facts, read_at)
+    return facts
+
+
+# Patches are merged server-side so a write never needs the current facts first.
+SET_FACTS_SQL = """
+    UPDATE user_profile
+    SET facts = COALESCE(facts, '{}'::jsonb) || $1::jsonb,
+        updated_at = NOW()
+    WHERE user_id = $2
+    RETURNING facts
+"""
+SET_STATE_SQL = """
+    UPDATE user_profile
+    SET facts = jsonb_set(
+            COALESCE(facts, '{}'::jsonb),
+            '{app_state}',
+            CASE WHEN jsonb_typeof(facts->'app_state') = 'object'
+                 THEN facts->'app_state' ELSE '{}'::jsonb END || $1::jsonb,
+            true
+        ),
+        updated_at = NOW()
+    WHERE user_id = $2
+    RETURNING facts
+"""
+
+
+async def _write_facts(sql: str, uid: int, patch: Dict[str, Any], *params: Any) -> None:
+    rows = await fetch(sql, patch, uid, *params)
+    if rows:
+        _facts_cache_put(uid, _parse_facts(rows[0].get("facts")))
+
+
 async def set_facts(uid: int, patch: Dict[str, Any]) -> None:
-    facts = await get_facts(uid)
-    facts.update(patch)
-    await execute("UPDATE user_profile SET facts=$1, updated_at=NOW() WHERE user_id=$2", facts, uid)
+    await _write_facts(SET_FACTS_SQL, uid, patch)
 
 
 async def app_state(uid: int) -> Dict[str, Any]:
@@ -115,11 +251,24 @@ async def app_state(uid: int) -> Dict[str, Any]:
 
 
 async def set_state(uid: int, patch: Dict[str, Any]) -> None:
-    facts = await get_facts(uid)
-    st = facts.get("app_state", {}) or {}
-    st.update(patch)
-    facts["app_state"] = st
-    await execute("UPDATE user_profile SET facts=$1, updated_at=NOW() WHERE user_id=$2", facts, uid)
+    await _write_facts(SET_STATE_SQL, uid, patch)
+
+
+# psycho_profile upsert and the "KNO done" app_state patch in one round-trip;
+# $1/$2 are the set_state patch/uid, $3.. the profile row.
+KNO_FINISH_SQL = """
+    WITH profile AS (
+        INSERT INTO psycho_profile(user_id,ei,sn,tf,jp,confidence,mbti_type,anchors,state)
+        VALUES($2,$3,$4,$5,$6,$7,$8,$9,$10)
+        ON CONFLICT (user_id) DO UPDATE
+        SET ei=EXCLUDED.ei,
+            sn=EXCLUDED.sn,
+            tf=EXCLUDED.tf,
+            jp=EXCLUDED.jp,
+            confidence=EXCLUDED.confidence,
+            updated_at=NOW()
+    )
+""" + SET_STATE_SQL
 
 
 async def kno_start(uid: int) -> None:
@@ -136,74 +285,36 @@ async def kno_next(uid: int) -> Optional[str]:
     return KNO[idx][1] + "\n\nОтветь 1 или 2, можно словами."
 
 
-async def kno_register(uid: int, text: str) -> Optional[str]:
+async def kno_register(uid: int, text: str, tl: Optional[str] = None) -> Optional[str]:
     st = await app_state(uid)
     idx = st.get("kno_idx", 0)
     if idx is None or idx >= len(KNO):
         return None
 
     key, _ = KNO[idx]
-    t = (text or "").strip().lower()
-
-    def pick(question_key: str, tt: str) -> int:
-        if tt in {"1", "первый", "первое", "первая", "слева"}:
-            return 1
-        if tt in {"2", "второй", "второе", "вторая", "справа"}:
-            return 2
-        if question_key.startswith("ei_"):
-            if re.search(r"наедин|тишин|один", tt):
-                return 2
-            if re.search(r"люд|общат|встреч", tt):
-                return 1
-        if question_key.startswith("sn_"):
-            if re.search(r"факт|конкрет|шаг", tt):
-                return 1
-            if re.search(r"смысл|иде|образ", tt):
-                return 2
-        if question_key.startswith("tf_"):
-            if re.search(r"логик|рацион|аргумент", tt):
-                return 1
-            if re.search(r"чувств|эмоци|ценност", tt):
-                return 2
-        if question_key.startswith("jp_"):
-            if re.search(r"план|распис|контрол", tt):
-                return 1
-            if re.search(r"свobod|свобод|импров|спонтан", tt):
-                return 2
-        return 1
+    t = tl if tl is not None else (text or "").strip().lower()
 
     answers = st.get("kno_answers", {}) or {}
-    answers[key] = pick(key, t)
+    answers[key] = kno_pick(key, t)
 
     idx += 1
     if idx >= len(KNO):
-        axes = {"E": 0, "I": 0, "S": 0, "N": 0, "T": 0, "F": 0, "J": 0, "P": 0}
-        for k, v in answers.items():
-            a, b = KNO_MAP[k]
-            axes[a if v == 1 else b] += 1
-
-        def norm(a: int, b: int) -> Tuple[float, float]:
-            s = a + b
-            return (a / (s or 1), b / (s or 1))
-
-        E, _I = norm(axes["E"], axes["I"])
-        _S, N = norm(axes["S"], axes["N"])
-        T, _F = norm(axes["T"], axes["F"])
-        J, _P = norm(axes["J"], axes["P"])
-
-        await execute(
-            """
-            INSERT INTO psycho_profile(user_id,ei,sn,tf,jp,confidence,mbti_type,anchors,state)
-            VALUES($1,$2,$3,$4,$5,$6,$7,$8,$9)
-            ON CONFLICT (user_id) DO UPDATE
-            SET ei=EXCLUDED.ei,
-                sn=EXCLUDED.sn,
-                tf=EXCLUDED.tf,
-                jp=EXCLUDED.jp,
-                confidence=EXCLUDED.confidence,
-                updated_at=NOW()
-            """,
+        counts = [0] * len(KNO_AXES)
+        for i, (k, _q) in enumerate(KNO):
+            v = answers.get(k)
+            if v is not None:
+                a, b = KNO_AXIS_IDX[i]
+                counts[a if v == 1 else b] += 1
+        E = _axis_share(counts, 0)
+        N = _axis_share(counts, 3)
+        T = _axis_share(counts, 4)
+        J = _axis_share(counts, 6)
+
+        style = comms_style({"ei": E, "sn": N, "tf": T, "jp": J})
+        await _write_facts(
+            KNO_FINISH_SQL,
             uid,
+            {"kno_done": True, "kno_idx": None, "kno_answers": answers, "style_cache": style},
             E,
             N,
             T,
@@ -213,8 +324,6 @@ async def kno_register(uid: int, text: str) -> Optional[str]:
             [],
             None,
         )
-
-        await set_state(uid, {"kno_done": True, "kno_idx": None, "kno_answers": answers})
         return (
             "Спасибо, я лучше понимаю, как с тобой говорить 💛\n"
             "Уверенность 40%\n"
@@ -225,73 +334,97 @@ async def kno_register(uid: int, text: str) -> Optional[str]:
     return KNO[idx][1] + "\n\nОтветь 1 или 2, можно словами."
 
 
-def comms_style(p: Dict[str, Any]) -> Dict[str, str]:
+def _style_for_bits(ei_hi: bool, sn_hi: bool, tf_hi: bool, jp_hi: bool) -> Dict[str, str]:
     return {
-        "tone": "активный" if p.get("ei", 0.5) >= 0.5 else "спокойный",
-        "detail": "смыслы" if p.get("sn", 0.5) >= 0.5 else "шаги",
-        "mind": "анализ" if p.get("tf", 0.5) >= 0.5 else "чувства",
-        "plan": "план" if p.get("jp", 0.5) >= 0.5 else "эксперимент",
+        "tone": "активный" if ei_hi else "спокойный",
+        "detail": "смыслы" if sn_hi else "шаги",
+        "mind": "анализ" if tf_hi else "чувства",
+        "plan": "план" if jp_hi else "эксперимент",
     }
 
 
-def reflect_emotion(text: str) -> str:
-    t = (text or "").lower()
-    if re.search(r"устал|напряж|тревож|злюсь|грустн|плохо|паник", t):
-        return "Слышу напряжение и заботу о результате. "
-    if re.search(r"спокойн|рад|легко|класс|хорошо", t):
-        return "Чувствую спокойствие и лёгкость. "
-    if re.search(r"не знаю|путаюсь|сомнева|непонятно", t):
-        return "Вижу, что хочется ясности. "
-    return "Я рядом и слышу тебя. "
+# Each axis only matters as >= 0.5, so there are 16 styles; index = ei,sn,tf,jp bits.
+# The dicts are shared: callers must not mutate them.
+COMMS_STYLES: Tuple[Dict[str, str], ...] = tuple(
+    _style_for_bits(bool(b & 8), bool(b & 4), bool(b & 2), bool(b & 1)) for b in range(16)
+)
+
+
+def comms_style(p: Dict[str, Any]) -> Dict[str, str]:
+    bits = (
+        (p.get("ei", 0.5) >= 0.5) << 3
+        | (p.get("sn", 0.5) >= 0.5) << 2
+        | (p.get("tf", 0.5) >= 0.5) << 1
+        | (p.get("jp", 0.5) >= 0.5)
+    )
+    return COMMS_STYLES[bits]
+
+
+# Keyed by detect_emotion's label, so a message is classified only once.
+REFLECT_TEXT: Dict[str, str] = {
+    "tense": "Слышу напряжение и заботу о результате. ",
+    "calm": "Чувствую спокойствие и лёгкость. ",
+    "uncertain": "Вижу, что хочется ясности. ",
+    "neutral": "Я рядом и слышу тебя. ",
+}
+
+
+def reflect_emotion(text: str, tl: Optional[str] = None, emo: Optional[str] = None) -> str:
+    if emo is None:
+        emo = detect_emotion(text, tl)
+    return REFLECT_TEXT[emo]
+
+
+JOKES: Tuple[str, ...] = (
+    "Иногда лучший выбор — выбрать один микрошаг. Потому что диван уже выбрал тебя 😄",
+    "Если сомневаешься — выбери вариант, где ты добрее к себе. Это почти всегда выигрыш 😉",
+    "Секрет продуктивности — начать. Остальное догонит 🚶‍♀️",
+    "Мозг любит завершать начатое. Запусти 10 минут — и он уже за тебя 🤖",
+)
+_rng = random.Random()
 
 
 def playful_oneline() -> str:
-    jokes = [
-        "Иногда лучший выбор — выбрать один микрошаг. Потому что диван уже выбрал тебя 😄",
-        "Если сомневаешься — выбери вариант, где ты добрее к себе. Это почти всегда выигрыш 😉",
-        "Секрет продуктивности — начать. Остальное догонит 🚶‍♀️",
-        "Мозг любит завершать начатое. Запусти 10 минут — и он уже за тебя 🤖",
-    ]
-    return jokes[int(time.time()) % len(jokes)]
+    return _rng.choice(JOKES)
 
 
 IntentFn = Callable[[Dict[str, str], bool], str]
 
-DECISION_RX = re.compile(r"(правильн|лучший).*выбор|как.*решен|принять.*решен", re.IGNORECASE)
-STRESS_RX = re.compile(r"стресс|тревог|паник|пережив|напряжен", re.IGNORECASE)
-PROCRAS_RX = re.compile(r"прокраст|не могу начать|откладыва", re.IGNORECASE)
-GOALS_RX = re.compile(r"цель|план|стратеги|куда двигаться|приоритет", re.IGNORECASE)
-BOUNDARY_RX = re.compile(r"границ|научиться отказывать|ассертивн|говорить нет", re.IGNORECASE)
-RELATION_RX = re.compile(r"отношен|конфликт|ссор|партнер|муж|жена|коллег", re.IGNORECASE)
-IMPOSTER_RX = re.compile(r"самозван|не достойн|недостаточн.*хорош", re.IGNORECASE)
-BURNOUT_RX = re.compile(r"выгора|усталость хронич|опустошен", re.IGNORECASE)
-SLEEP_RX = re.compile(r"сон|бессонниц|режим сна", re.IGNORECASE)
-MOTIV_RX = re.compile(r"мотивац|нет сил|не хочется", re.IGNORECASE)
-ANGER_RX = re.compile(r"злость|ярость|злюсь|бесит", re.IGNORECASE)
-SAD_RX = re.compile(r"груст|печаль|потеря|скорбь", re.IGNORECASE)
-MINDFUL_RX = re.compile(r"майндфул|осознанн|дыхани|медитац", re.IGNORECASE)
-CBT_RX = re.compile(r"рефрейм|когнитивн|автоматическ.*мысл", re.IGNORECASE)
-SMART_RX = re.compile(r"smart|смарт", re.IGNORECASE)
-EISEN_RX = re.compile(r"эйзенхау|важно-срочн|матриц", re.IGNORECASE)
-POMODORO_RX = re.compile(r"помодор|тайм[- ]?бокс|time[- ]?box", re.IGNORECASE)
-
-FINANCE_RX = re.compile(r"(деньг|финанс|доход|расход|бюджет|подушк|долг|кредит|ипотек|копит|не хватает|денежн.*тревог)", re.IGNORECASE)
-
-PARTNER_RX = re.compile(r"(найти|поиск|встретить).*(партн|муж|жен|парня|девушк)", re.IGNORECASE)
-CAREER_RX = re.compile(r"(карь|повышен|рост|развитие|зарплат|оценк).*работ", re.IGNORECASE)
-SPEAK_RX = re.compile(r"(выступлен|презентац|публичн.*выступ|самопрезент)", re.IGNORECASE)
-NEGOT_RX = re.compile(r"(переговор|торг|обсужд.*услов|договор)", re.IGNORECASE)
-INTERVIEW_RX = re.compile(r"(собеседован|интервью|hr|рекрутер)", re.IGNORECASE)
-WEEKLY_RX = re.compile(r"(еженедел|обзор|ретросп|review)", re.IGNORECASE)
-STUDY_RX = re.compile(r"(учеб|экзам|курс|диплом|учит|школ|универ)", re.IGNORECASE)
-ADHD_RX = re.compile(r"(adhd|сдвр|рассеянн|невниман|гиперактив)", re.IGNORECASE)
-DECLUTTER_RX = re.compile(r"(расхлам|разбор.*вещ|уборк|минимализм)", re.IGNORECASE)
-PARENT_RX = re.compile(r"(ребен|детьм|родительств|подрост|воспитан|моего сына|мою дочь)", re.IGNORECASE)
-HABITS_RX = re.compile(r"(привычк|спорт|питани|вода|здоров|шаги)", re.IGNORECASE)
-CREATIVE_RX = re.compile(r"(творческ|креативн|писател|муз|идеи.*не ид|застой)", re.IGNORECASE)
-RELOC_RX = re.compile(r"(переезд|релокац|смена стран|город|адаптац)", re.IGNORECASE)
-GRAT_RX = re.compile(r"(благодарност|журнал благодарност|gratitude)", re.IGNORECASE)
-MORNING_RX = re.compile(r"(утренн.*ритуал|morning routine|утро.*начать)", re.IGNORECASE)
+DECISION_RX = re.compile(r"(правильн|лучший).*выбор|как.*решен|принять.*решен")
+STRESS_RX = re.compile(r"стресс|тревог|паник|пережив|напряжен")
+PROCRAS_RX = re.compile(r"прокраст|не могу начать|откладыва")
+GOALS_RX = re.compile(r"цель|план|стратеги|куда двигаться|приоритет")
+BOUNDARY_RX = re.compile(r"границ|научиться отказывать|ассертивн|говорить нет")
+RELATION_RX = re.compile(r"отношен|конфликт|ссор|партнер|муж|жена|коллег")
+IMPOSTER_RX = re.compile(r"самозван|не достойн|недостаточн.*хорош")
+BURNOUT_RX = re.compile(r"выгора|усталость хронич|опустошен")
+SLEEP_RX = re.compile(r"сон|бессонниц|режим сна")
+MOTIV_RX = re.compile(r"мотивац|нет сил|не хочется")
+ANGER_RX = re.compile(r"злость|ярость|злюсь|бесит")
+SAD_RX = re.compile(r"груст|печаль|потеря|скорбь")
+MINDFUL_RX = re.compile(r"майндфул|осознанн|дыхани|медитац")
+CBT_RX = re.compile(r"рефрейм|когнитивн|автоматическ.*мысл")
+SMART_RX = re.compile(r"smart|смарт")
+EISEN_RX = re.compile(r"эйзенхау|важно-срочн|матриц")
+POMODORO_RX = re.compile(r"помодор|тайм[- ]?бокс|time[- ]?box")
+
+FINANCE_RX = re.compile(r"(деньг|финанс|доход|расход|бюджет|подушк|долг|кредит|ипотек|копит|не хватает|денежн.*тревог)")
+
+PARTNER_RX = re.compile(r"(найти|поиск|встретить).*(партн|муж|жен|парня|девушк)")
+CAREER_RX = re.compile(r"(карь|повышен|рост|развитие|зарплат|оценк).*работ")
+SPEAK_RX = re.compile(r"(выступлен|презентац|публичн.*выступ|самопрезент)")
+NEGOT_RX = re.compile(r"(переговор|торг|обсужд.*услов|договор)")
+INTERVIEW_RX = re.compile(r"(собеседован|интервью|hr|рекрутер)")
+WEEKLY_RX = re.compile(r"(еженедел|обзор|ретросп|review)")
+STUDY_RX = re.compile(r"(учеб|экзам|курс|диплом|учит|школ|универ)")
+ADHD_RX = re.compile(r"(adhd|сдвр|рассеянн|невниман|гиперактив)")
+DECLUTTER_RX = re.compile(r"(расхлам|разбор.*вещ|уборк|минимализм)")
+PARENT_RX = re.compile(r"(ребен|детьм|родительств|подрост|воспитан|моего сына|мою дочь)")
+HABITS_RX = re.compile(r"(привычк|спорт|питани|вода|здоров|шаги)")
+CREATIVE_RX = re.compile(r"(творческ|креативн|писател|муз|идеи.*не ид|застой)")
+RELOC_RX = re.compile(r"(переезд|релокац|смена стран|город|адаптац)")
+GRAT_RX = re.compile(r"(благодарност|журнал благодарност|gratitude)")
+MORNING_RX = re.compile(r"(утренн.*ритуал|morning routine|утро.*начать)")
 
 
 def reply_decision(style: Dict[str, str], humor_on: bool) -> str:
@@ -301,41 +434,44 @@ def reply_decision(style: Dict[str, str], humor_on: bool) -> str:
         "2) Таблица 3×3: плюсы / минусы / ценности. Что поддерживает твои ценности — то и берём.",
         "3) Шкалирование (0–10): насколько важно? Что поднимет оценку на +1 сегодня?",
         "4) Мини-эксперимент: шаг на 15 минут, чтобы проверить гипотезу на практике.",
-        f"\n{('Чуть иронии: ' + playful_oneline()) if humor_on else ''}",
-        "\nКакой инструмент откликается? Могу помочь применить его на твоём примере.",
     ]
+    if humor_on:
+        lines.append("\nЧуть иронии: " + playful_oneline())
+    lines.append("\nКакой инструмент откликается? Могу помочь применить его на твоём примере.")
     return "\n".join(lines)
 
 
 def reply_stress(style: Dict[str, str], humor: bool) -> str:
-    return (
+    text = (
         "План анти-стресса за 5 минут:\n"
         "• 30–60 сек дыхание 4-7-8 — 4 цикла.\n"
         "• Заземление 5-4-3-2-1: 5 вижу, 4 ощущаю, 3 слышу, 2 пахнет, 1 вкус.\n"
         "• Сигналы безопасности телу: расправь плечи, расслабь челюсть, вода.\n"
-        "• Один микрошаг на 10 минут.\n"
-        f"\n{playful_oneline() if humor else ''}\n"
-        f"{'Что из этого попробуешь сейчас?' if style['plan']=='план' else 'С чего начнём — дыхание или микрошаг?'}"
+        "• Один микрошаг на 10 минут.\n\n"
     )
+    if humor:
+        text += playful_oneline() + "\n"
+    return text + ("Что из этого попробуешь сейчас?" if style["plan"] == "план" else "С чего начнём — дыхание или микрошаг?")
 
 
 def reply_procras(style: Dict[str, str], humor: bool) -> str:
-    return (
+    text = (
         "Чтобы сдвинуть прокрастинацию:\n"
         "1) Правило 2 минут — начни с действия на 120 секунд.\n"
         "2) Time-boxing 25/5 — один помидор: 25 фокус, 5 — отдых.\n"
         "3) Формула задачи: Глагол + Объект + 25 минут.\n"
-        "4) «Смешно маленький шаг»: открыть файл и написать одну строку.\n"
-        f"\n{playful_oneline() if humor else ''}\nКакой микрошаг берём на 10 минут?"
+        "4) «Смешно маленький шаг»: открыть файл и написать одну строку.\n\n"
     )
+    if humor:
+        text += playful_oneline() + "\n"
+    return text + "Какой микрошаг берём на 10 минут?"
 
 
 def reply_goals(style: Dict[str, str], humor: bool) -> str:
-    return (
-        "Сформируем ясность:\n"
-        "• SMART  • Эйзенхауэр  • Следующий видимый шаг  • Критерий завершения.\n"
-        f"\n{playful_oneline() if humor else ''}\nС какой целью начнём? Опишешь в 1–2 предложениях?"
-    )
+    text = "Сформируем ясность:\n• SMART  • Эйзенхауэр  • Следующий видимый шаг  • Критерий завершения.\n\n"
+    if humor:
+        text += playful_oneline() + "\n"
+    return text + "С какой целью начнём? Опишешь в 1–2 предложениях?"
 
 
 def reply_boundaries(style: Dict[str, str], humor: bool) -> str:
@@ -415,12 +551,13 @@ def reply_pomodoro(style: Dict[str, str], humor: bool) -> str:
 
 
 def reply_finance(style: Dict[str, str], humor: bool) -> str:
-    return (
+    text = (
         "Денежная тревога — спокойно и по делу. План 20–30 минут:\n"
         "1) 5 выдохов + вода  2) Снимок: доход/расход/долги/подушка  3) Три рычага: урезать, подзаработать, копить  4) Микрошаг сегодня (15 мин).\n"
-        f"{'Бонус — немного иронии: ' + playful_oneline() if humor else ''}\n"
-        "С чего начнём? Могу дать простой шаблон бюджета."
     )
+    if humor:
+        text += "Бонус — немного иронии: " + playful_oneline() + "\n"
+    return text + "С чего начнём? Могу дать простой шаблон бюджета."
 
 
 def reply_partner(style: Dict[str, str], humor: bool) -> str:
@@ -534,7 +671,18 @@ INTENTS: List[Tuple[re.Pattern, IntentFn, str]] = [
 
 CODE2FN: Dict[str, IntentFn] = {code: fn for (_rx, fn, code) in INTENTS}
 
-MENU_TRIGGERS = re.compile(r"\b(по какой теме|какая тема|меню|непонятно|что выбрать|где здесь)\b", re.IGNORECASE)
+
+def match_intent(t: str) -> Optional[str]:
+    # INTENTS order is the routing priority; first pattern found anywhere wins.
+    for rx, _fn, code in INTENTS:
+        if rx.search(t):
+            return code
+    return None
+
+
+MENU_TRIGGERS = re.compile(r"\b(по какой теме|какая тема|меню|непонятно|что выбрать|где здесь)\b")
+HUMOR_RX = re.compile(r"\bпошути\b|немного юмора|чуть иронии")
+QUESTION_RX = re.compile(r"\b(как|что|зачем|почему|какой|какая|когда)\b")
 
 MENU_LIST: List[Tuple[str, str]] = [
     ("decision", "Принять решение"),
@@ -561,14 +709,17 @@ MENU_LIST: List[Tuple[str, str]] = [
 ]
 
 
+MENU_MAPPING: Dict[str, str] = {str(i + 1): code for i, (code, _title) in enumerate(MENU_LIST[:10])}
+MENU_TEXT = "\n".join(
+    ["Выбери тему цифрой, а я сразу предложу план:\n"]
+    + [f"{i}) {title}" for i, (_code, title) in enumerate(MENU_LIST[:10], start=1)]
+    + ["\nМожно написать свою тему словами — я пойму."]
+)
+
+
 async def compose_menu(uid: int) -> str:
-    mapping = {str(i + 1): code for i, (code, _title) in enumerate(MENU_LIST[:10])}
-    await set_state(uid, {"menu_map": mapping})
-    lines = ["Выбери тему цифрой, а я сразу предложу план:\n"]
-    for i, (_code, title) in enumerate(MENU_LIST[:10], start=1):
-        lines.append(f"{i}) {title}")
-    lines.append("\nМожно написать свою тему словами — я пойму.")
-    return "\n".join(lines)
+    await set_state(uid, {"menu_map": MENU_MAPPING})
+    return MENU_TEXT
 
 
 async def try_menu_choice(uid: int, text: str, style: Dict[str, str], humor_on: bool) -> Optional[str]:
@@ -592,61 +743,160 @@ def step_question(style: Dict[str, str]) -> str:
     return "Какой маленький шаг ты готова наметить на сегодня?" if style["plan"] == "план" else "Какой лёгкий эксперимент попробуешь сначала?"
 
 
-async def build_reply(uid: int, user_text: str, humor_on: bool) -> str:
-    pr = await fetch("SELECT ei,sn,tf,jp,mbti_type FROM psycho_profile WHERE user_id=$1", uid)
-    p = pr[0] if pr else {"ei": 0.5, "sn": 0.5, "tf": 0.5, "jp": 0.5}
-    st = comms_style(p)
+def _question_reply(emo: str, style: Dict[str, str]) -> str:
+    return f"{REFLECT_TEXT[emo]}Попробую по делу. {focus_question(style)}\n\n{step_question(style)}"
+
+
+# Replies to a question depend only on the emotion and two style fields.
+QUESTION_REPLIES: Dict[Tuple[str, str, str], str] = {
+    (emo, detail, plan): _question_reply(emo, {"detail": detail, "plan": plan})
+    for emo in REFLECT_TEXT
+    for detail in ("смыслы", "шаги")
+    for plan in ("план", "эксперимент")
+}
+
+
+async def build_reply(
+    uid: int, user_text: str, humor_on: bool, tl: Optional[str] = None, emo: Optional[str] = None
+) -> str:
     t = (user_text or "").strip()
+    # Empty input and unmapped menu numbers can only end in the menu: skip the
+    # profile lookup and every regex below.
+    if not t or (len(t) < 4 and t.isdigit()):
+        return await compose_menu(uid)
 
-    if MENU_TRIGGERS.search(t):
+    st = await get_profile_style(uid)
+    if tl is None:
+        tl = t.lower()
+
+    if MENU_TRIGGERS.search(tl):
         return await compose_menu(uid)
 
-    if re.search(r"\bпошути\b|немного юмора|чуть иронии", t.lower()):
+    if HUMOR_RX.search(tl):
         return playful_oneline() + "\n\n" + focus_question(st)
 
-    for rx, fn, _code in INTENTS:
-        if rx.search(t):
-            return fn(st, humor_on)
+    code = match_intent(tl)
+    if code:
+        return CODE2FN[code](st, humor_on)
 
-    if t.endswith("?") or re.search(r"\b(как|что|зачем|почему|какой|какая|когда)\b", t.lower()):
-        return f"{reflect_emotion(t)}Попробую по делу. {focus_question(st)}\n\n{step_question(st)}"
+    if t.endswith("?") or QUESTION_RX.search(tl):
+        if emo is None:
+            emo = detect_emotion(t, tl)
+        reply = QUESTION_REPLIES.get((emo, st.get("detail"), st.get("plan")))
+        return reply if reply is not None else _question_reply(emo, st)
 
     if len(t) < 4:
         return await compose_menu(uid)
 
     return (
-        f"{reflect_emotion(t)}Чтобы продвинуться по теме — выдели 5–10 минут и выпиши 3 шага/мысли. "
+        f"{reflect_emotion(t, tl, emo)}Чтобы продвинуться по теме — выдели 5–10 минут и выпиши 3 шага/мысли. "
         f"Какой из них попробуешь сегодня? Если хочется — скажи «пошути», добавлю лёгкой иронии. "
         f"Или выбери тему цифрой:\n{await compose_menu(uid)}"
     )
 
 
+# Last assistant reply per user, kept by log_event; dialog_events is only
+# queried on a miss (e.g. after a restart).
+LAST_REPLY_MAX = int(os.getenv("LAST_REPLY_MAX", "10000"))
+LAST_REPLY: "OrderedDict[int, str]" = OrderedDict()
+
+
+def _remember_reply(uid: int, text: str) -> None:
+    LAST_REPLY[uid] = text
+    LAST_REPLY.move_to_end(uid)
+    while len(LAST_REPLY) > LAST_REPLY_MAX:
+        LAST_REPLY.popitem(last=False)
+
+
 async def not_duplicate(uid: int, reply: str) -> str:
-    last = await fetch(
-        "SELECT text FROM dialog_events WHERE user_id=$1 AND role='assistant' ORDER BY id DESC LIMIT 1",
-        uid,
-    )
-    if last and (last[0].get("text") or "").strip() == reply.strip():
+    last = LAST_REPLY.get(uid)
+    if last is None:
+        rows = await fetch(
+            "SELECT text FROM dialog_events WHERE user_id=$1 AND role='assistant' ORDER BY id DESC LIMIT 1",
+            uid,
+        )
+        last = (rows[0].get("text") or "") if rows else ""
+        _remember_reply(uid, last)
+    if last.strip() == reply.strip():
         return reply + "\n\nЕсли хочется, посмотрим на это под другим углом 😉"
     return reply
 
 
 async def get_profile_style(uid: int) -> Dict[str, str]:
+    # psycho_profile only changes when the KNO finishes, which stores the style.
+    cached = (await app_state(uid)).get("style_cache")
+    if cached:
+        return cached
     pr = await fetch("SELECT ei,sn,tf,jp FROM psycho_profile WHERE user_id=$1", uid)
-    p = pr[0] if pr else {"ei": 0.5, "sn": 0.5, "tf": 0.5, "jp": 0.5}
-    return comms_style(p)
+    if not pr:
+        return comms_style({"ei": 0.5, "sn": 0.5, "tf": 0.5, "jp": 0.5})
+    style = comms_style(pr[0])
+    await set_state(uid, {"style_cache": style})
+    return style
+
+
+# dialog_events is write-only on the request path: rows are queued and
+# inserted in batches by a background task started in api/main.py.
+INSERT_EVENT_SQL = "INSERT INTO dialog_events(user_id,role,text,mi_phase,emotion,relevance) VALUES($1,$2,$3,$4,$5,$6)"
+EVENT_BATCH_MAX = int(os.getenv("EVENT_BATCH_MAX", "200"))
+EVENT_QUEUE_MAX = int(os.getenv("EVENT_QUEUE_MAX", "10000"))
+_event_queue: "Optional[asyncio.Queue[Tuple[Any, ...]]]" = None
+_event_writer: Optional[asyncio.Task] = None
+
+
+async def _write_events(queue: "asyncio.Queue[Tuple[Any, ...]]") -> None:
+    while True:
+        batch = [await queue.get()]
+        while len(batch) < EVENT_BATCH_MAX and not queue.empty():
+            batch.append(queue.get_nowait())
+        try:
+            await executemany(INSERT_EVENT_SQL, batch)
+        except Exception:
+            # executemany is all-or-nothing: one bad row (e.g. a missing
+            # user_profile) must not drop other users' events.
+            logger.warning("dialog_events batch insert failed, retrying row by row (rows=%s)", len(batch))
+            for row in batch:
+                try:
+                    await execute(INSERT_EVENT_SQL, *row)
+                except Exception:
+                    logger.exception("dialog_events insert failed (uid=%s role=%s)", row[0], row[1])
+        finally:
+            for _ in batch:
+                queue.task_done()
+
+
+def start_event_writer() -> None:
+    global _event_queue, _event_writer
+    if _event_writer is not None:
+        return
+    _event_queue = asyncio.Queue(maxsize=EVENT_QUEUE_MAX)
+    _event_writer = asyncio.create_task(_write_events(_event_queue))
+
+
+async def stop_event_writer(timeout: float = 5.0) -> None:
+    global _event_queue, _event_writer
+    if _event_writer is None or _event_queue is None:
+        return
+    try:
+        await asyncio.wait_for(_event_queue.join(), timeout)
+    except asyncio.TimeoutError:
+        logger.warning("dialog_events queue not drained on shutdown (left=%s)", _event_queue.qsize())
+    _event_writer.cancel()
+    _event_writer = None
+    _event_queue = None
 
 
 async def log_event(uid: int, role: str, text: str, mi_phase: str, emotion: str = "neutral", relevance: bool = True) -> None:
-    await execute(
-        "INSERT INTO dialog_events(user_id,role,text,mi_phase,emotion,relevance) VALUES($1,$2,$3,$4,$5,$6)",
-        uid,
-        role,
-        text,
-        mi_phase,
-        emotion,
-        relevance,
-    )
+    if role == "assistant":
+        _remember_reply(uid, text or "")
+    row = (uid, role, text, mi_phase, emotion, relevance)
+    if _event_queue is not None:
+        try:
+            _event_queue.put_nowait(row)
+            return
+        except asyncio.QueueFull:
+            logger.warning("dialog_events queue is full, writing inline (uid=%s)", uid)
+    await execute(INSERT_EVENT_SQL, *row)
 
 
 async def idempotency_guard(update_id: Optional[int]) -> bool:
@@ -1,7 +1,9 @@
 from __future__ import annotations
 
+import asyncio
 import logging
 import os
+from typing import List, Optional, Tuple
 
 import httpx
 
@@ -9,18 +11,95 @@ logger = logging.getLogger("anima")
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
 
+SEND_WORKERS = int(os.getenv("TG_SEND_WORKERS", "8"))
+SEND_QUEUE_MAX = int(os.getenv("TG_SEND_QUEUE_MAX", "1000"))
 
-async def tg_send(chat_id: int, text: str) -> None:
+# chat_id -> queue by modulo, so sends overlap across chats but stay in order
+# within one chat (a reply is often two messages back to back).
+_queues: "List[asyncio.Queue[Tuple[int, str]]]" = []
+_workers: List[asyncio.Task] = []
+_http: Optional[httpx.AsyncClient] = None
+
+
+def create_client() -> httpx.AsyncClient:
+    # one keep-alive (HTTP/2) connection pool to api.telegram.org per process
+    global _http
+    if _http is None:
+        _http = httpx.AsyncClient(
+            timeout=15,
+            http2=True,
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+        )
+    return _http
+
+
+async def close_client() -> None:
+    global _http
+    if _http is not None:
+        await _http.aclose()
+        _http = None
+
+
+def _client() -> httpx.AsyncClient:
+    # created by create_client() on app startup
+    if _http is None:
+        raise RuntimeError("Telegram HTTP client is not initialized")
+    return _http
+
+
+async def _send(chat_id: int, text: str) -> None:
     if not TELEGRAM_TOKEN:
         logger.info("[DRY RUN] -> %s: %s", chat_id, (text or "")[:300])
         return
 
     try:
-        async with httpx.AsyncClient(timeout=15) as client:
-            r = await client.post(
-                f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage",
-                json={"chat_id": chat_id, "text": text},
-            )
-            r.raise_for_status()
+        r = await _client().post(
+            f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage",
+            json={"chat_id": chat_id, "text": text},
+        )
+        r.raise_for_status()
     except Exception:
         logger.exception("Telegram send failed (chat_id=%s)", chat_id)
+
+
+async def _send_worker(queue: "asyncio.Queue[Tuple[int, str]]") -> None:
+    while True:
+        chat_id, text = await queue.get()
+        try:
+            await _send(chat_id, text)
+        finally:
+            queue.task_done()
+
+
+def start_senders() -> None:
+    if _workers:
+        return
+    for _ in range(max(1, SEND_WORKERS)):
+        queue: "asyncio.Queue[Tuple[int, str]]" = asyncio.Queue(maxsize=SEND_QUEUE_MAX)
+        _queues.append(queue)
+        _workers.append(asyncio.create_task(_send_worker(queue)))
+
+
+async def stop_senders(timeout: float = 5.0) -> None:
+    if not _workers:
+        return
+    try:
+        await asyncio.wait_for(asyncio.gather(*(q.join() for q in _queues)), timeout)
+    except asyncio.TimeoutError:
+        logger.warning("Telegram send queues not drained on shutdown (left=%s)", sum(q.qsize() for q in _queues))
+    for w in _workers:
+        w.cancel()
+    _workers.clear()
+    _queues.clear()
+
+
+async def tg_send(chat_id: int, text: str) -> None:
+    if not _queues:
+        await _send(chat_id, text)
+        return
+    # Never wait for room: the webhook holds a pooled DB connection while it
+    # runs, so blocking here would let a slow Telegram drain the DB pool.
+    try:
+        _queues[chat_id % len(_queues)].put_nowait((chat_id, text))
+    except asyncio.QueueFull:
+        logger.error("Telegram send queue is full, dropping message (chat_id=%s)", chat_id)
@@ -96,6 +96,8 @@ CREATE INDEX IF NOT EXISTS idx_dialog_user_created ON dialog_events(user_id, cre
 CREATE INDEX IF NOT EXISTS idx_dialog_role         ON dialog_events(role);
 CREATE INDEX IF NOT EXISTS idx_dialog_phase        ON dialog_events(mi_phase);
 CREATE INDEX IF NOT EXISTS idx_dialog_emotion      ON dialog_events(emotion);
+-- Latest row per user (not_duplicate fallback: ORDER BY id DESC LIMIT 1)
+CREATE INDEX IF NOT EXISTS idx_dialog_user_id_desc ON dialog_events(user_id, id DESC);
 
 CREATE INDEX IF NOT EXISTS idx_psycho_conf         ON psycho_profile(confidence DESC);
 